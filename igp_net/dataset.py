@@ -162,7 +162,10 @@ class URPDataset(Dataset):
             raise ValueError("Invalid data type")
 
 
-def get_dataloader(data_dir, split, batch_size, num_workers, data_config, device='cpu',shuffle=True):
+def get_dataloader(data_dir, split, batch_size, num_workers, data_config, device='cpu',shuffle=True,
+                   pin_memory=False, persistent_workers=False):
     dataset = URPDataset(data_dir, split, data_config,device=device)
-    dataloader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=shuffle)
+    dataloader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=shuffle,
+                            pin_memory=pin_memory and dataset.device.type == 'cpu',
+                            persistent_workers=persistent_workers and num_workers > 0)
     return dataloader
\ No newline at end of file
@@ -77,6 +77,44 @@ def recenter_local_map_and_pose_for_env(
     local_pose[e] = global_pose[e] - origins[e]
 
 
+def recenter_local_map_and_pose(
+    envs: Tensor,
+    local_map: Tensor,
+    global_map: Tensor,
+    local_pose: Tensor,
+    global_pose: Tensor,
+    lmb: Tensor,
+    origins: Tensor,
+    map_size_parameters: MapSizeParameters,
+):
+    """Batched version of recenter_local_map_and_pose_for_env for all
+    environments in envs (a 1D tensor of environment indices).
+    """
+    p = map_size_parameters
+    global_loc = (global_pose[envs, :2] * 100 / p.resolution).int()
+    boundaries = get_local_map_boundaries_batch(global_loc, map_size_parameters)
+    lmb[envs] = boundaries.to(lmb.dtype)
+    y1, x1 = boundaries[:, 0], boundaries[:, 2]
+    origins[envs] = torch.stack(
+        [
+            x1 * p.resolution / 100.0,
+            y1 * p.resolution / 100.0,
+            torch.zeros_like(x1, dtype=origins.dtype),
+        ],
+        1,
+    ).to(origins.dtype)
+
+    # Gather every local map window with a single advanced index
+    window = torch.arange(p.local_map_size, device=local_map.device)
+    rows = (y1.long().unsqueeze(1) + window).view(-1, 1, p.local_map_size, 1)
+    cols = (x1.long().unsqueeze(1) + window).view(-1, 1, 1, p.local_map_size)
+    channels = torch.arange(local_map.size(1), device=local_map.device)
+    local_map[envs] = global_map[
+        envs.view(-1, 1, 1, 1), channels.view(1, -1, 1, 1), rows, cols
+    ]
+    local_pose[envs] = global_pose[envs] - origins[envs]
+
+
 def get_local_map_boundaries(
     global_loc: torch.IntTensor, map_size_parameters: MapSizeParameters
 ) -> torch.IntTensor:
@@ -114,3 +152,23 @@ def get_local_map_boundaries(
         x2 = torch.tensor(p.global_map_size, device=device, dtype=dtype)
 
     return torch.stack([y1, y2, x1, x2])
+
+
+def get_local_map_boundaries_batch(
+    global_loc: torch.IntTensor, map_size_parameters: MapSizeParameters
+) -> torch.IntTensor:
+    """Batched version of get_local_map_boundaries, from global sensor
+    locations of shape (N, 2) to boundaries of shape (N, 4)."""
+    p = map_size_parameters
+
+    if p.global_downscaling > 1:
+        # same as shifting the window back inside the global map when it
+        # crosses an edge, as the local map is never larger than the global one
+        corner = (global_loc - p.local_map_size // 2).clamp(
+            0, p.global_map_size - p.local_map_size
+        )
+    else:
+        corner = torch.zeros_like(global_loc)
+    x1, y1 = corner[:, 0], corner[:, 1]
+
+    return torch.stack([y1, y1 + p.local_map_size, x1, x1 + p.local_map_size], 1)
@@ -4,20 +4,19 @@
 from typing import Tuple, Optional, Dict, List
 from torch.nn.utils.rnn import pad_sequence
 import cv2
-import matplotlib.pyplot as plt
 import numpy as np
 import skimage.morphology
 import torch
 import torch.nn as nn
-import trimesh.transformations as tra
 from torch import IntTensor, Tensor
 from torch.nn import functional as F
 
-import home_robot.mapping.map_utils as mu
+import mapping.map_utils as mu
 from utils import depth as du
 import home_robot.utils.pose as pu
 import home_robot.utils.rotation as ru
 from mapping.semantic.constants import MapConstants as MC
+from utils.transformation import get_rot_trans_grid_batch
 from utils.visualization import (
     display_grayscale,
     display_rgb,
@@ -38,6 +37,14 @@ from utils.visualization import (
 debug_maps = False
 
 
+@torch.jit.script
+def _safe_logit(x: Tensor, eps: float = 1e-6) -> Tensor:
+    """Same as torch.logit(x, eps), scripted so the clamp, division and log
+    can be fused into a single kernel."""
+    x = x.clamp(eps, 1.0 - eps)
+    return torch.log(x / (1.0 - x))
+
+
 class Categorical2DSemanticMapModule(nn.Module):
     """
     This class is responsible for updating a dense 2D semantic map with one channel
@@ -82,6 +89,10 @@ class Categorical2DSemanticMapModule(nn.Module):
         probability_prior: float = 0.2,
         close_range: int = 150, # 1.5m
         confident_threshold: float = 0.7,
+        voxel_dtype: torch.dtype = torch.float32,
+        single_pass_resample: bool = False,
+        use_compile: bool = False,
+        channels_last: bool = False,
     ):
         """
         Arguments:
@@ -108,6 +119,24 @@ class Categorical2DSemanticMapModule(nn.Module):
              consider it as obstacle
             must_explore_close: reduce the distance we need to get to things to make them work
             min_obs_height_cm: minimum height of obstacles (in centimetres)
+            voxel_dtype: storage dtype of the occupancy and category voxel grid
+             (e.g. torch.bfloat16 to halve its memory traffic). The prob channel
+             is always splatted into a separate float32 grid, its voxels go
+             through a logit that bf16 accumulation cannot resolve; height
+             projections are upcast so that map channels stay in float32
+            single_pass_resample: resample the agent view into the map with one
+             composed rotation + translation grid instead of the rotation grid
+             then the translation grid. Faster, but it skips the intermediate
+             bilinear pass, which changes every resampled channel (sharper
+             edges, fewer explored cells); the IGP predictor was trained on
+             two-pass maps
+            use_compile: compile the voxel update and the map features with
+             torch.compile (torch >= 2.0 only). Needs a working inductor backend
+             (a C++ toolchain on CPU, triton on CUDA) and adds a compilation
+             cost on the first forward call
+            channels_last: max pool the global map features in channels_last.
+             Pair with a map state built with channels_last=True; off by
+             default as it is slower than NCHW on CPU
         """
         super().__init__()
 
@@ -154,10 +183,13 @@ class Categorical2DSemanticMapModule(nn.Module):
         self.global_map_size = self.global_map_size_cm // self.resolution
         self.local_map_size = self.local_map_size_cm // self.resolution
         self.xy_resolution = self.z_resolution = map_resolution
+        self.metres_to_cells = 100.0 / self.xy_resolution
         self.vision_range = vision_range
         self.explored_radius = explored_radius
         self.been_close_to_radius = been_close_to_radius
         self.du_scale = du_scale
+        # number of points in the downscaled point cloud
+        self.n_points = (self.screen_h // self.du_scale) * (self.screen_w // self.du_scale)
         self.cat_pred_threshold = cat_pred_threshold
         self.exp_pred_threshold = exp_pred_threshold
         self.map_pred_threshold = map_pred_threshold
@@ -180,27 +212,104 @@ class Categorical2DSemanticMapModule(nn.Module):
         )
         self.shift_loc = [self.vision_range * self.xy_resolution // 2, 0, np.pi / 2.0]
 
+        # Height ranges summed over for the (all, filtered, agent) height projections
+        height_masks = torch.zeros(3, self.max_voxel_height - self.min_voxel_height)
+        height_masks[0, :] = 1
+        height_masks[1, self.filtered_min_height : self.max_mapped_height] = 1
+        height_masks[2, self.min_mapped_height : self.max_mapped_height] = 1
+        self.register_buffer("height_masks", height_masks, persistent=False)
+
+        # Bounds (y1, y2, x1, x2) of the vision range crop within the agent view
+        x1 = self.local_map_size_cm // (self.xy_resolution * 2) - self.vision_range // 2
+        y1 = self.local_map_size_cm // (self.xy_resolution * 2)
+        self.agent_view_crop = (y1, y1 + self.vision_range, x1, x1 + self.vision_range)
+
+        # (y, x) offsets of the 5x5 square stamped around the current location
+        stamp_dy, stamp_dx = torch.meshgrid(
+            torch.arange(-2, 3), torch.arange(-2, 3), indexing="ij"
+        )
+        self.register_buffer("stamp_dy", stamp_dy, persistent=False)
+        self.register_buffer("stamp_dx", stamp_dx, persistent=False)
+
+        # torch.compile is only available from torch 2.0 on
+        self.channels_last = channels_last
+        self.use_compile = use_compile and hasattr(torch, "compile")
+        if self.use_compile:
+            self._update_voxel_map_fn = torch.compile(self._update_voxel_map, dynamic=False)
+            self._get_map_features_fn = torch.compile(
+                self._get_map_features, dynamic=False
+            )
+        else:
+            self._update_voxel_map_fn = self._update_voxel_map
+            self._get_map_features_fn = self._get_map_features
+
+        # Fixed-shape scratch tensors reused across frames, see _get_scratch_buffer
+        self._scratch_buffers: Dict[str, Tensor] = {}
+
+        # Affine map from point cloud coordinates (in cm) to the voxel grid in [-1, 1]
+        voxel_range = self.max_voxel_height - self.min_voxel_height
+        xyz_scale = torch.tensor(
+            [
+                2.0 / (self.vision_range * self.xy_resolution),
+                2.0 / (self.vision_range * self.xy_resolution),
+                2.0 / (voxel_range * self.z_resolution),
+            ]
+        )
+        xyz_bias = torch.tensor(
+            [
+                -(self.vision_range // 2.0) / self.vision_range * 2.0,
+                -(self.vision_range // 2.0) / self.vision_range * 2.0,
+                -((self.max_voxel_height + self.min_voxel_height) // 2.0)
+                / voxel_range
+                * 2.0,
+            ]
+        )
+        self.register_buffer("xyz_scale", xyz_scale.view(3, 1), persistent=False)
+        self.register_buffer("xyz_bias", xyz_bias.view(3, 1), persistent=False)
+
         # For cleaning up maps
         self.dilate_obstacles = dilate_obstacles
         # self.dilate_kernel = np.ones((dilate_size, dilate_size))
         self.dilate_size = dilate_size
         # self.dilate_iter = dilate_iter
+        self.register_buffer(
+            "dilate_kernel",
+            torch.ones((1, 1, dilate_size, dilate_size), dtype=torch.float32),
+            persistent=False,
+        )
         
         self.probabilistic = probabilistic
+        self.voxel_dtype = voxel_dtype
+        self.single_pass_resample = single_pass_resample
         # For probabilistic map updates
-        self.dist_rows = torch.arange(1, self.vision_range + 1).float()
-        self.dist_rows = self.dist_rows.unsqueeze(1).repeat(1, self.vision_range)
-        self.dist_cols = torch.arange(1, self.vision_range + 1).float() - (self.vision_range / 2)
-        self.dist_cols = torch.abs(self.dist_cols)
-        self.dist_cols = self.dist_cols.unsqueeze(0).repeat(self.vision_range, 1)
+        # constant tensors are registered as non-persistent buffers so that they
+        # follow the module on .to(device) instead of being copied every frame
+        dist_rows = torch.arange(1, self.vision_range + 1).float()
+        dist_rows = dist_rows.unsqueeze(1).repeat(1, self.vision_range)
+        dist_cols = torch.arange(1, self.vision_range + 1).float() - (self.vision_range / 2)
+        dist_cols = torch.abs(dist_cols)
+        dist_cols = dist_cols.unsqueeze(0).repeat(self.vision_range, 1)
+        self.register_buffer("dist_rows", dist_rows, persistent=False)
+        self.register_buffer("dist_cols", dist_cols, persistent=False)
 
         self.close_range = close_range // self.xy_resolution # 150 cm
+        # gate that keeps only the close range rows of the vision range
+        close_gate = torch.ones((1, 1, self.vision_range, self.vision_range))
+        close_gate[:, :, self.close_range :, :] = 0
+        self.register_buffer("close_gate", close_gate, persistent=False)
         self.confident_threshold = confident_threshold # above which considered a hard detection
-        self.prior_logit = torch.logit(torch.tensor(probability_prior)) # prior probability of objects
-        self.vr_matrix = torch.zeros((1, self.vision_range, self.vision_range))
-        self.prior_matrix = torch.full((1, self.vision_range, self.vision_range), self.prior_logit)
-
-        self.dialate_kernel = torch.ones((1, 1, dilate_size, dilate_size), dtype=torch.float32)
+        prior_logit = torch.logit(torch.tensor(probability_prior)) # prior probability of objects
+        self.register_buffer("prior_logit", prior_logit, persistent=False)
+        self.register_buffer(
+            "vr_matrix",
+            torch.zeros((1, self.vision_range, self.vision_range)),
+            persistent=False,
+        )
+        self.register_buffer(
+            "prior_matrix",
+            torch.full((1, self.vision_range, self.vision_range), prior_logit.item()),
+            persistent=False,
+        )
 
     @torch.no_grad()
     def forward(
@@ -296,10 +405,13 @@ class Categorical2DSemanticMapModule(nn.Module):
         local_map, local_pose = init_local_map.clone(), init_local_pose.clone()
         global_map, global_pose = init_global_map.clone(), init_global_pose.clone()
         lmb, origins = init_lmb.clone(), init_origins.clone()
+        # Read the per-env flags back once instead of syncing on every lookup
+        seq_dones = seq_dones.tolist()
+        seq_update_global = seq_update_global.tolist()
         for t in range(sequence_length):
             # Reset map and pose for episodes done at time step t
             for e in range(batch_size):
-                if seq_dones[e, t]:
+                if seq_dones[e][t]:
                     mu.init_map_and_pose_for_env(
                         e,
                         local_map,
@@ -319,17 +431,25 @@ class Categorical2DSemanticMapModule(nn.Module):
                 seq_camera_poses,
                 detection_results[t],
             )
-            for e in range(batch_size):
-                if seq_update_global[e, t]:
-                    self._update_global_map_and_pose_for_env(
-                        e, local_map, global_map, local_pose, global_pose, lmb, origins
-                    )
+            update_global = [seq_update_global[e][t] for e in range(batch_size)]
+            if any(update_global):
+                self._update_global_map_and_pose(
+                    update_global,
+                    local_map,
+                    global_map,
+                    local_pose,
+                    global_pose,
+                    lmb,
+                    origins,
+                )
 
             seq_local_pose[:, t] = local_pose
             seq_global_pose[:, t] = global_pose
             seq_lmb[:, t] = lmb
             seq_origins[:, t] = origins
-            seq_map_features[:, t] = self._get_map_features(local_map, global_map)
+            seq_map_features[:, t] = self._get_map_features_fn(local_map, global_map)
+            if debug_maps:
+                self._plot_map_features(local_map, seq_map_features[:, t])
             seq_extras[t] = extras
 
         return (
@@ -375,13 +495,14 @@ class Categorical2DSemanticMapModule(nn.Module):
             # TODO: make consistent between sim and real
             # hab_angles = pt.matrix_to_euler_angles(camera_pose[:, :3, :3], convention="YZX")
             # angles = pt.matrix_to_euler_angles(camera_pose[:, :3, :3], convention="ZYX")
-            angles = torch.Tensor(
-                [tra.euler_from_matrix(p[:3, :3].cpu(), "rzyx") for p in camera_pose]
-            )
             # For habitat - pull x angle
             # tilt = angles[:, -1]
-            # For real robot
-            tilt = angles[:, 1]
+            # For real robot - y angle of tra.euler_from_matrix(R, "rzyx"),
+            # computed batched on device instead of per sample on cpu
+            rot = camera_pose[:, :3, :3]
+            tilt = torch.atan2(
+                -rot[:, 2, 0], torch.sqrt(rot[:, 0, 0] ** 2 + rot[:, 1, 0] ** 2)
+            )
 
             # Get the agent pose
             # hab_agent_height = camera_pose[:, 1, 3] * 100
@@ -391,8 +512,9 @@ class Categorical2DSemanticMapModule(nn.Module):
             tilt = torch.zeros(batch_size)
             agent_height = self.agent_height
 
+        # out-of-place so that a float obs is never modified through the view
         depth = obs[:, 3, :, :].float()
-        depth[depth > self.max_depth] = 0
+        depth = torch.where(depth > self.max_depth, depth.new_zeros(()), depth)
         point_cloud_t = du.get_point_cloud_from_z_t(
             depth, self.camera_matrix, device, scale=self.du_scale
         )
@@ -418,7 +540,6 @@ class Categorical2DSemanticMapModule(nn.Module):
         if self.debug_mode:
             print()
             print("------------------------------")
-            print("agent angles =", angles)
             print("agent tilt   =", tilt)
             print("agent height =", agent_height, "preset =", self.agent_height)
             xyz = point_cloud_base_coords[0].reshape(-1, 3)
@@ -437,21 +558,26 @@ class Categorical2DSemanticMapModule(nn.Module):
         # we assume total_num_instance is the same for all batch (padded with 0)
 
         # first take max prob value for pixel
-        prob_feat = torch.zeros(batch_size, 1, h // self.du_scale * w // self.du_scale).to(device)
-        if detection_result is not None:
+        # prob_feat stays None when nothing is detected, the prob channel of feat
+        # is then zero-filled in place
+        prob_feat = None
+        if (
+            detection_result is not None
+            and detection_result["masks"].shape[1] != 0 # some instance detected
+        ):
             scores = detection_result["scores"] # [B, total_num_instance]
             classes = detection_result["classes"] # [B, total_num_instance]
             masks = detection_result["masks"].float() # [B, total_num_instance, H, W]
             relevance = detection_result["relevance"] #torch.tensor([0, 1, 0.7 , 0, 0]).to(device)
 
-            if masks.shape[1] != 0: # no instance detected
-                score_relevence = scores * relevance[classes] # [B, total_num_instance]
-                prob_feat = torch.einsum('bnhw,bn->bnhw',masks, score_relevence) # [B, N, H, W]
-                prob_feat,_ = torch.max(prob_feat, dim=1, keepdim=True) # [B,1, H, W]
-                # we use maxpool2d instead of avgpool2d to preserve the prob value
-                prob_feat = nn.MaxPool2d(self.du_scale)(prob_feat).view(
-                        batch_size, 1,  h // self.du_scale * w // self.du_scale
-                    ) # [B, 1,  H*W] after scaling
+            score_relevence = scores * relevance[classes] # [B, total_num_instance]
+            prob_feat = (masks * score_relevence.view(batch_size, -1, 1, 1)).amax(
+                dim=1, keepdim=True
+            ) # [B, 1, H, W]
+            # we use maxpool2d instead of avgpool2d to preserve the prob value
+            prob_feat = F.max_pool2d(prob_feat, self.du_scale).view(
+                    batch_size, 1, self.n_points
+                ) # [B, 1,  H*W] after scaling
         #################### prob features ####################
 
         point_cloud_map_coords = du.transform_pose_t(
@@ -468,22 +594,26 @@ class Categorical2DSemanticMapModule(nn.Module):
             )
 
         voxel_channels = 2 + self.num_sem_categories # first is for 3d structure, last is for prob feat
-        
-        init_grid = torch.zeros(
-            batch_size,
-            voxel_channels,
+        # with a low precision voxel_dtype the prob channel gets its own float32 grid
+        split_prob = self.voxel_dtype != torch.float32
+        grid_size = (
             self.vision_range,
             self.vision_range,
             self.max_voxel_height - self.min_voxel_height,
-            device=device,
-            dtype=torch.float32,
         )
-        feat = torch.ones(
-            batch_size,
-            voxel_channels-1, # cat + prob
-            self.screen_h // self.du_scale * self.screen_w // self.du_scale,
-            device=device,
-            dtype=torch.float32,
+
+        init_grid = self._get_scratch_buffer(
+            "init_grid",
+            (batch_size, voxel_channels - int(split_prob), *grid_size),
+            device,
+            self.voxel_dtype,
+        ).zero_()
+        # point features are small next to the grid and stay in float32
+        feat = self._get_scratch_buffer(
+            "feat",
+            (batch_size, voxel_channels, self.n_points), # 1 + cat + prob
+            device,
+            torch.float32,
         )
 
         # PMO
@@ -493,52 +623,51 @@ class Categorical2DSemanticMapModule(nn.Module):
         #     )
 
         # feat: 0 is for explored area, 1:-1 is for instance, -1 is for prob
-        feat[:, 1:, :] = nn.AvgPool2d(self.du_scale)(obs[:, 4:, :, :]).view(
-            batch_size, obs_channels - 4, h // self.du_scale * w // self.du_scale
+        feat[:, 0, :] = 1.0
+        feat[:, 1:-1, :] = F.avg_pool2d(obs[:, 4:, :, :], self.du_scale).view(
+            batch_size, obs_channels - 4, self.n_points
         )
-        feat = torch.cat([feat,prob_feat],dim=1)
+        if prob_feat is None:
+            feat[:, -1, :] = 0.0
+        else:
+            feat[:, -1:, :] = prob_feat
 
-        XYZ_cm_std = point_cloud_map_coords.float()
-        XYZ_cm_std[..., :2] = XYZ_cm_std[..., :2] / self.xy_resolution
-        XYZ_cm_std[..., :2] = (
-            (XYZ_cm_std[..., :2] - self.vision_range // 2.0) / self.vision_range * 2.0
-        )
-        XYZ_cm_std[..., 2] = XYZ_cm_std[..., 2] / self.z_resolution
-        XYZ_cm_std[..., 2] = (
-            (
-                XYZ_cm_std[..., 2]
-                - (self.max_voxel_height + self.min_voxel_height) // 2.0
-            )
-            / (self.max_voxel_height - self.min_voxel_height)
-            * 2.0
-        )
-        XYZ_cm_std = XYZ_cm_std.permute(0, 3, 1, 2) # [B, 3, H, W]
-        XYZ_cm_std = XYZ_cm_std.view(
-            XYZ_cm_std.shape[0],
-            XYZ_cm_std.shape[1],
-            XYZ_cm_std.shape[2] * XYZ_cm_std.shape[3],
-        ) # [B, 3, H*W]
+        # [B, H, W, 3] -> [B, 3, H*W] normalized to [-1, 1] in a single pass
+        XYZ_cm_std = point_cloud_map_coords.float().reshape(batch_size, -1, 3).transpose(1, 2)
+        XYZ_cm_std = torch.addcmul(self.xyz_bias, XYZ_cm_std, self.xyz_scale)
 
         # voxels = du.splat_feat_nd_max(init_grid, feat, XYZ_cm_std).transpose(2, 3)
-        voxels = du.splat_feat_nd(init_grid, feat, XYZ_cm_std).transpose(2, 3)
-
-        all_height_proj = voxels[:,:1,...].sum(4)
+        if split_prob:
+            init_prob_grid = self._get_scratch_buffer(
+                "init_prob_grid",
+                (batch_size, 1, *grid_size),
+                device,
+                torch.float32,
+            ).zero_()
+            grid = du.splat_feat_nd(init_grid, feat[:, :-1], XYZ_cm_std)
+            prob_grid = du.splat_feat_nd(init_prob_grid, feat[:, -1:], XYZ_cm_std)
+        else:
+            grid = du.splat_feat_nd(init_grid, feat, XYZ_cm_std)
+            prob_grid = grid[:, -1:]
+        voxels = grid.transpose(2, 3)
+        prob_voxels = prob_grid[:, 0].transpose(1, 2) # [B, X, Y, Z] -> [B, Y, X, Z]
+
+        # All three height projections in one pass over the contiguous grid:
+        # [B, C, W, H, Z] @ [Z, 3] -> [3, B, C, H, W]
+        height_proj = torch.matmul(grid, self.height_masks.t().to(grid.dtype))
+        height_proj = height_proj.permute(4, 0, 1, 3, 2).float()
+        all_height_proj = height_proj[0, :, :1]
         # ignore objects that are too low
-        filtered_height_proj = voxels[...,
-            self.filtered_min_height : self.max_mapped_height
-        ].sum(4)
+        filtered_height_proj = height_proj[1]
         # the agent_height range corresponds to 0cm to 120cm 
-        agent_height_proj = voxels[:,:1,:,:,
-            self.min_mapped_height : self.max_mapped_height
-        ].sum(4)
+        agent_height_proj = height_proj[2, :, :1]
      
         fp_map_pred = agent_height_proj[:, 0:1, :, :]
         fp_exp_pred = all_height_proj[:, 0:1, :, :]
         fp_map_pred = fp_map_pred / self.map_pred_threshold
         fp_exp_pred = fp_exp_pred / self.exp_pred_threshold
 
-        close_exp = fp_exp_pred.clone() # [B, 1, H, W]
-        close_exp[:,:, self.close_range:,:] = 0 # only consider the close range 1.5m
+        close_exp = fp_exp_pred * self.close_gate # only consider the close range 1.5m
         
         ################ probabilitic ################
         
@@ -585,12 +714,12 @@ class Categorical2DSemanticMapModule(nn.Module):
         # # prior_matrix[fp_exp_pred.squeeze(1) > 0] = self.prior_logit # [B, H, W]
 
         ########### end PMO ###################
-        prob_map, _ = voxels[:,-1,:,:,self.filtered_min_height : self.max_mapped_height].max(3)
+        prob_map, _ = prob_voxels[:,:,:,self.filtered_min_height : self.max_mapped_height].max(3)
         # prob_map = voxels[:,-1,:,:,self.filtered_min_height : self.max_mapped_height].sum(3)
 
         # TODO: should we use close_range or exp, or just all viewable area?
         # we can use a smaller prior for all viewable area, and bigger prior for close range
-        prob_logit = torch.logit(prob_map,eps=1e-6) - self.prior_logit # 
+        prob_logit = _safe_logit(prob_map, 1e-6) - self.prior_logit # 
         prob_logit[fp_exp_pred.squeeze(1) == 0] = 0 # set unviewable area to 0
         prob_logit = torch.clamp(prob_logit, min=-10, max=10)        
 
@@ -599,20 +728,31 @@ class Categorical2DSemanticMapModule(nn.Module):
         ############### end probabilistic ###############
 
 
-        agent_view = torch.zeros(
-            batch_size,
-            MC.NON_SEM_CHANNELS + self.num_sem_categories,
-            self.local_map_size_cm // self.xy_resolution,
-            self.local_map_size_cm // self.xy_resolution,
-            device=device,
-            dtype=dtype,
+        # agent_view holds the map channels followed by the occupied voxel
+        # channels. Only the vision range crop is written below (fully, every
+        # frame), so the rest stays zero from allocation. It is kept
+        # channels_last so that grid_sample reads all channels of a map cell
+        # from contiguous memory
+        agent_view = self._get_scratch_buffer(
+            "agent_view",
+            (
+                batch_size,
+                MC.NON_SEM_CHANNELS + self.num_sem_categories + self.max_mapped_height,
+                self.local_map_size_cm // self.xy_resolution,
+                self.local_map_size_cm // self.xy_resolution,
+            ),
+            device,
+            dtype,
+            memory_format=torch.channels_last,
         )
 
         # Update agent view from the fp_map_pred
         if self.dilate_obstacles:
             
-            fp_map_pred =  torch.nn.functional.conv2d(
-                fp_map_pred, self.dialate_kernel.to(device), padding=self.dilate_size // 2
+            # window sum, not max: fractional counts that add up to >= 1 in a window
+            # mark the whole window as an obstacle
+            fp_map_pred = F.conv2d(
+                fp_map_pred, self.dilate_kernel, padding=self.dilate_size // 2
             ).clamp(0, 1)
             # for i in range(fp_map_pred.shape[0]):
             #     env_map = fp_map_pred[i, 0].cpu().numpy()
@@ -631,15 +771,12 @@ class Categorical2DSemanticMapModule(nn.Module):
             #     # fp_map_pred[i, 0] = torch.tensor(env_map_eroded)
             #     fp_map_pred[i, 0] = torch.tensor(median_filtered)
 
-        x1 = self.local_map_size_cm // (self.xy_resolution * 2) - self.vision_range // 2
-        x2 = x1 + self.vision_range
-        y1 = self.local_map_size_cm // (self.xy_resolution * 2)
-        y2 = y1 + self.vision_range
+        y1, y2, x1, x2 = self.agent_view_crop
         agent_view[:, MC.OBSTACLE_MAP : MC.OBSTACLE_MAP + 1, y1:y2, x1:x2] = fp_map_pred
         agent_view[:, MC.EXPLORED_MAP : MC.EXPLORED_MAP + 1, y1:y2, x1:x2] = fp_exp_pred
         agent_view[:, MC.BEEN_CLOSE_MAP : MC.BEEN_CLOSE_MAP + 1, y1:y2, x1:x2] = close_exp
         agent_view[:, MC.PROBABILITY_MAP , y1:y2, x1:x2] = prob_logit
-        agent_view[:, MC.VOXEL_START: MC.NON_SEM_CHANNELS, y1:y2, x1:x2] = voxels[:,-1,:,:,
+        agent_view[:, MC.VOXEL_START: MC.NON_SEM_CHANNELS, y1:y2, x1:x2] = prob_voxels[:,:,:,
             : self.max_mapped_height
         ].permute(0,3,1,2) # [B, H, W, C] -> [B, C, H, W]
         
@@ -653,22 +790,17 @@ class Categorical2DSemanticMapModule(nn.Module):
         #     detected
         #     / self.cat_pred_threshold
         # )
-        agent_view[:, MC.NON_SEM_CHANNELS :, y1:y2, x1:x2] = (
-            filtered_height_proj[:, 1:-1] / self.cat_pred_threshold
+        agent_view[
+            :, MC.NON_SEM_CHANNELS : MC.NON_SEM_CHANNELS + self.num_sem_categories, y1:y2, x1:x2
+        ] = (
+            filtered_height_proj[:, 1 : 1 + self.num_sem_categories]
+            / self.cat_pred_threshold
         )
         
         #### for voxel ####
-        occupaid_voxel = torch.zeros(
-            batch_size,
-            self.max_mapped_height,
-            self.local_map_size_cm // self.xy_resolution,
-            self.local_map_size_cm // self.xy_resolution,
-            device=device,
-            dtype=dtype,
-        )
-            
-        occupaid_voxel[..., y1:y2, x1:x2] = voxels[:,0,:,:, : self.max_mapped_height].permute(0,3,1,2)
-        agent_view = torch.cat([agent_view, occupaid_voxel], dim=1)
+        agent_view[:, MC.NON_SEM_CHANNELS + self.num_sem_categories :, y1:y2, x1:x2] = voxels[
+            :,0,:,:, : self.max_mapped_height
+        ].permute(0,3,1,2)
         ####################
         
         current_pose = pu.get_new_pose_batch(prev_pose.clone(), pose_delta)
@@ -683,9 +815,14 @@ class Categorical2DSemanticMapModule(nn.Module):
         )
         st_pose[:, 2] = 90.0 - (st_pose[:, 2])
 
-        rot_mat, trans_mat = ru.get_grid(st_pose, agent_view.size(), dtype)
-        rotated = F.grid_sample(agent_view, rot_mat, align_corners=True)
-        translated = F.grid_sample(rotated, trans_mat, align_corners=True)
+        if self.single_pass_resample:
+            # rotation and translation composed into a single resampling pass
+            st_grid = get_rot_trans_grid_batch(st_pose, agent_view.size()).to(dtype)
+            translated = F.grid_sample(agent_view, st_grid, align_corners=True)
+        else:
+            rot_mat, trans_mat = ru.get_grid(st_pose, agent_view.size(), dtype)
+            rotated = F.grid_sample(agent_view, rot_mat, align_corners=True)
+            translated = F.grid_sample(rotated, trans_mat, align_corners=True)
 
         
         #### for voxel ####
@@ -698,13 +835,14 @@ class Categorical2DSemanticMapModule(nn.Module):
                     list(range(MC.NON_SEM_CHANNELS, MC.NON_SEM_CHANNELS+self.num_sem_categories))
         translated[:,idx_no_prob] = torch.clamp(translated[:,idx_no_prob], min=0.0, max=1.0)
 
-        maps = torch.cat((prev_map.unsqueeze(1), translated.unsqueeze(1)), 1)
-        current_map, _ = torch.max(
-            maps[:, :, : MC.NON_SEM_CHANNELS + self.num_sem_categories], 1
-        )
+        # elementwise ops follow the memory format of prev_map, so a channels_last
+        # map stays channels_last
+        current_map = torch.maximum(prev_map, translated)
 
         ############### Bayesian update ###############
-        current_map[:, MC.PROBABILITY_MAP, :, :] = torch.sum(maps[:, :, MC.PROBABILITY_MAP,:, :], 1)
+        current_map[:, MC.PROBABILITY_MAP, :, :] = (
+            prev_map[:, MC.PROBABILITY_MAP, :, :] + translated[:, MC.PROBABILITY_MAP, :, :]
+        )
         current_map[:, MC.PROBABILITY_MAP, :, :] = torch.clamp(current_map[:, MC.PROBABILITY_MAP, :, :], min=-10, max=10)
         goal_idx = MC.NON_SEM_CHANNELS + 1 # goal object
 
@@ -740,41 +878,14 @@ class Categorical2DSemanticMapModule(nn.Module):
         # we only update occupaid voxel (by current observation)
         # if voxel is empty in the previous map (isinf), then we assign the logit of the voxel: 
         # otherwise, update with l(p^t) = l(p^t-1) + l(p^t) - l(p)
-        is_occupaid = occupaid_voxel_st >0.5
-        is_pre_empty = prev_map[:,MC.VOXEL_START:MC.NON_SEM_CHANNELS,:,:].isinf()
-        need_assign_logit = is_occupaid & is_pre_empty
-        need_addition_logit = is_occupaid & ~is_pre_empty
-        voxel_logit = torch.logit(
-            translated[:,MC.VOXEL_START:MC.NON_SEM_CHANNELS,:,:],eps=1e-6)
-        
-        updated = prev_map[:,MC.VOXEL_START:MC.NON_SEM_CHANNELS,:,:].clone()
-        # case 1
-        updated[need_assign_logit] = voxel_logit[need_assign_logit]
-        # current_map[:,MC.VOXEL_START:MC.NON_SEM_CHANNELS,:,:][need_assign_logit] = voxel_logit[need_assign_logit]
-        # case 2
-        updated[need_addition_logit] = prev_map[:,MC.VOXEL_START:MC.NON_SEM_CHANNELS,:,:][need_addition_logit] + \
-            voxel_logit[need_addition_logit] - self.prior_logit
-        # current_map[:,MC.VOXEL_START:MC.NON_SEM_CHANNELS,:,:][need_addition_logit] += \
-        #     (voxel_logit[need_addition_logit] - self.prior_logit)
-        
-        is_post_occupaid = ~updated.isinf()
-        updated[is_post_occupaid] = torch.clamp(updated[is_post_occupaid], min=-10, max=10)
-        # is_post_occupaid = ~current_map[:,MC.VOXEL_START:MC.NON_SEM_CHANNELS,:,:].isinf()
-        # current_map[:,MC.VOXEL_START:MC.NON_SEM_CHANNELS,:,:].clamp_(min=-10,max=10)
-
-        
-        # if the prob of a voxel is very low and is closely checked, then we set it to -10
-        # NOTE: same reasoning as above.
-        # However, as we don't know if the voxel is visible or not, we mark all voxels that
-        # are both close and occupaid as low prob
-        # we need to use an additional channel in order to know if the voxel has been 
-        # closely looked at
-        # confident_no_obj = ( updated < self.prior_logit ) & is_occupaid \
-        #                 & (current_map[:, MC.BEEN_CLOSE_MAP].unsqueeze(1).repeat(1,self.max_mapped_height, 1,1)==1) # [B, H, W] -> [B, C, H, W
-        confident_no_obj = confident_no_obj.unsqueeze(1).repeat(1,self.max_mapped_height, 1,1) # [B, H, W] -> [B, C, H, W]
-
-        updated[confident_no_obj & is_post_occupaid] = -10
-        current_map[:,MC.VOXEL_START:MC.NON_SEM_CHANNELS,:,:] = updated
+        voxel_logit = _safe_logit(
+            translated[:,MC.VOXEL_START:MC.NON_SEM_CHANNELS,:,:], 1e-6)
+        current_map[:,MC.VOXEL_START:MC.NON_SEM_CHANNELS,:,:] = self._update_voxel_map_fn(
+            prev_map[:,MC.VOXEL_START:MC.NON_SEM_CHANNELS,:,:],
+            voxel_logit,
+            occupaid_voxel_st,
+            confident_no_obj,
+        )
         
         ############ how about use voxel map for prob map
         # is_post_occupaid_proj = is_post_occupaid.max(dim=1)[0]
@@ -788,42 +899,49 @@ class Categorical2DSemanticMapModule(nn.Module):
         # TODO: it is always in the center, do we need it?
         current_map[:, MC.CURRENT_LOCATION, :, :].fill_(0.0)
         curr_loc = current_pose[:, :2] # 245, 240 
-        curr_loc = (curr_loc * 100.0 / self.xy_resolution).int()
-
-        for e in range(batch_size):
-            x, y = curr_loc[e]
-            current_map[
-                e,
-                MC.CURRENT_LOCATION : MC.CURRENT_LOCATION + 2,
-                y - 2 : y + 3,
-                x - 2 : x + 3,
-            ].fill_(1.0)
-
-            # Set a disk around the agent to explored
-            # This is around the current agent - we just sort of assume we know where we are
-            # TODO being close to should be in the agent's camera frustum and within a certain distance
-            # try:
-            #     radius = 10
-            #     explored_disk = torch.from_numpy(skimage.morphology.disk(radius))
-            #     current_map[
-            #         e,
-            #         MC.EXPLORED_MAP,
-            #         y - radius : y + radius + 1,
-            #         x - radius : x + radius + 1,
-            #     ][explored_disk == 1] = 1
-            #     # Record the region the agent has been close to using a disc centered at the agent
-            #     radius = self.been_close_to_radius // self.resolution
-            #     been_close_disk = torch.from_numpy(skimage.morphology.disk(radius))
-            #     current_map[
-            #         e,
-            #         MC.BEEN_CLOSE_MAP,
-            #         y - radius : y + radius + 1,
-            #         x - radius : x + radius + 1,
-            #     ][been_close_disk == 1] = 1
-            # except IndexError:
-            #     pass
+        # kept on device, never read back as python ints
+        curr_loc = (curr_loc * self.metres_to_cells).long()
+
+        # Stamp all envs at once, with the square clamped to the map bounds
+        map_size = current_map.shape[-1]
+        ys = (curr_loc[:, 1, None, None] + self.stamp_dy).clamp(0, map_size - 1)
+        xs = (curr_loc[:, 0, None, None] + self.stamp_dx).clamp(0, map_size - 1)
+        env_idx = torch.arange(batch_size, device=device).view(-1, 1, 1, 1)
+        channel_idx = torch.arange(
+            MC.CURRENT_LOCATION, MC.CURRENT_LOCATION + 2, device=device
+        ).view(1, -1, 1, 1)
+        current_map.index_put_(
+            (env_idx, channel_idx, ys.unsqueeze(1), xs.unsqueeze(1)),
+            current_map.new_ones(()),
+        )
+
+        # Set a disk around the agent to explored
+        # This is around the current agent - we just sort of assume we know where we are
+        # TODO being close to should be in the agent's camera frustum and within a certain distance
+        # try:
+        #     radius = 10
+        #     explored_disk = torch.from_numpy(skimage.morphology.disk(radius))
+        #     current_map[
+        #         e,
+        #         MC.EXPLORED_MAP,
+        #         y - radius : y + radius + 1,
+        #         x - radius : x + radius + 1,
+        #     ][explored_disk == 1] = 1
+        #     # Record the region the agent has been close to using a disc centered at the agent
+        #     radius = self.been_close_to_radius // self.resolution
+        #     been_close_disk = torch.from_numpy(skimage.morphology.disk(radius))
+        #     current_map[
+        #         e,
+        #         MC.BEEN_CLOSE_MAP,
+        #         y - radius : y + radius + 1,
+        #         x - radius : x + radius + 1,
+        #     ][been_close_disk == 1] = 1
+        # except IndexError:
+        #     pass
 
         if debug_maps:
+            import matplotlib.pyplot as plt
+
             current_map = current_map.cpu()
             explored = current_map[0, MC.EXPLORED_MAP].numpy()
             been_close = current_map[0, MC.BEEN_CLOSE_MAP].numpy()
@@ -882,9 +1000,95 @@ class Categorical2DSemanticMapModule(nn.Module):
 
         return current_map, current_pose, extras
 
-    def _update_global_map_and_pose_for_env(
+    def _update_voxel_map(
         self,
-        e: int,
+        prev_voxels: Tensor,
+        voxel_logit: Tensor,
+        occupaid_voxel_st: Tensor,
+        confident_no_obj: Tensor,
+    ) -> Tensor:
+        """Bayesian update of the voxel logit channels. This is a chain of
+        pointwise ops over the voxel slab, compiled with torch.compile when
+        the module is built with use_compile=True (see _update_voxel_map_fn).
+
+        Arguments:
+            prev_voxels: voxel logits of the previous local map, -inf for voxels
+             never observed, of shape (batch_size, max_mapped_height, M, M)
+            voxel_logit: logits of the current observation in map coordinates of
+             shape (batch_size, max_mapped_height, M, M)
+            occupaid_voxel_st: occupancy of the current observation in map
+             coordinates of shape (batch_size, max_mapped_height, M, M)
+            confident_no_obj: cells confidently known not to hold the goal object
+             of shape (batch_size, M, M)
+
+        Returns:
+            updated: voxel logits of the current local map of shape
+             (batch_size, max_mapped_height, M, M)
+        """
+        # -inf marks voxels that have never been observed; the "seen" mask is
+        # derived once from the previous map and then updated with boolean ops
+        is_occupaid = occupaid_voxel_st >0.5
+        is_pre_seen = ~prev_voxels.isinf()
+        
+        # case 1: voxel empty in the previous map -> assign the logit
+        # case 2: voxel seen before -> l(p^t) = l(p^t-1) + l(p^t) - l(p)
+        # computed out-of-place so the slab is traversed once per select
+        updated = torch.where(
+            is_pre_seen, prev_voxels + voxel_logit - self.prior_logit, voxel_logit
+        )
+        updated = torch.where(is_occupaid, updated, prev_voxels)
+
+        # voxel logits are finite, so a voxel is seen after this update iff it
+        # was seen before or is occupied now; only those are clamped, the others
+        # keep their -inf marker
+        is_post_occupaid = is_pre_seen | is_occupaid
+        updated = torch.where(is_post_occupaid, updated.clamp(min=-10, max=10), prev_voxels)
+
+        # if the prob of a voxel is very low and is closely checked, then we set it to -10
+        # NOTE: same reasoning as above.
+        # However, as we don't know if the voxel is visible or not, we mark all voxels that
+        # are both close and occupaid as low prob
+        # we need to use an additional channel in order to know if the voxel has been 
+        # closely looked at
+        # confident_no_obj = ( updated < self.prior_logit ) & is_occupaid \
+        #                 & (current_map[:, MC.BEEN_CLOSE_MAP].unsqueeze(1).repeat(1,self.max_mapped_height, 1,1)==1) # [B, H, W] -> [B, C, H, W
+        # [B, H, W] -> [B, 1, H, W], broadcast over the voxel height channels
+        confident_no_obj = confident_no_obj.unsqueeze(1)
+
+        updated = torch.where(
+            confident_no_obj & is_post_occupaid, updated.new_full((), -10.0), updated
+        )
+        return updated
+
+    def _get_scratch_buffer(
+        self,
+        name: str,
+        size: Tuple[int, ...],
+        device: torch.device,
+        dtype: torch.dtype,
+        memory_format: torch.memory_format = torch.contiguous_format,
+    ) -> Tensor:
+        """Get a scratch tensor that is reused across calls. It is zero-initialized
+        when (re)allocated, i.e. on first use or when size, device, dtype or memory
+        format change, and otherwise holds whatever the previous call left in it.
+        """
+        buffer = self._scratch_buffers.get(name)
+        if (
+            buffer is None
+            or buffer.shape != size
+            or buffer.device != device
+            or buffer.dtype != dtype
+            or not buffer.is_contiguous(memory_format=memory_format)
+        ):
+            buffer = torch.empty(
+                size, device=device, dtype=dtype, memory_format=memory_format
+            ).zero_()
+            self._scratch_buffers[name] = buffer
+        return buffer
+
+    def _update_global_map_and_pose(
+        self,
+        update_global: List[bool],
         local_map: Tensor,
         global_map: Tensor,
         local_pose: Tensor,
@@ -892,13 +1096,27 @@ class Categorical2DSemanticMapModule(nn.Module):
         lmb: Tensor,
         origins: Tensor,
     ):
-        """Update global map and pose and re-center local map and pose for a
-        particular environment.
+        """Update global map and pose and re-center local map and pose for
+        all environments flagged in update_global, batched over environments
+        with one launch per op for all of them.
         """
-        global_map[e, :, lmb[e, 0] : lmb[e, 1], lmb[e, 2] : lmb[e, 3]] = local_map[e]
-        global_pose[e] = local_pose[e] + origins[e]
-        mu.recenter_local_map_and_pose_for_env(
-            e,
+        envs = torch.tensor(
+            [e for e, update in enumerate(update_global) if update],
+            device=local_map.device,
+        )
+        n_channels = local_map.size(1)
+        window = torch.arange(self.local_map_size, device=local_map.device)
+        env_idx = envs.view(-1, 1, 1, 1)
+        channel_idx = torch.arange(n_channels, device=local_map.device).view(1, -1, 1, 1)
+
+        # Write the local maps into their window of the global maps
+        rows = (lmb[envs, 0:1].long() + window).view(-1, 1, self.local_map_size, 1)
+        cols = (lmb[envs, 2:3].long() + window).view(-1, 1, 1, self.local_map_size)
+        global_map.index_put_((env_idx, channel_idx, rows, cols), local_map[envs])
+        global_pose[envs] = local_pose[envs] + origins[envs]
+
+        mu.recenter_local_map_and_pose(
+            envs,
             local_map,
             global_map,
             local_pose,
@@ -921,40 +1139,35 @@ class Categorical2DSemanticMapModule(nn.Module):
             map_features: semantic map features of shape
              (batch_size, 2 * MC.NON_SEM_CHANNELS + num_sem_categories, M, M)
         """
-        map_features_channels = 2 * MC.NON_SEM_CHANNELS + self.num_sem_categories
-
-        map_features = torch.zeros(
-            local_map.size(0),
-            map_features_channels,
-            self.local_map_size,
-            self.local_map_size,
-            device=local_map.device,
-            dtype=local_map.dtype,
-        )
-
-        # Local obstacles, explored area, and current and past position
-        map_features[:, 0 : MC.NON_SEM_CHANNELS, :, :] = local_map[
-            :, 0 : MC.NON_SEM_CHANNELS, :, :
-        ]
         # Global obstacles, explored area, and current and past position
-        map_features[
-            :, MC.NON_SEM_CHANNELS : 2 * MC.NON_SEM_CHANNELS, :, :
-        ] = nn.MaxPool2d(self.global_downscaling)(
-            global_map[:, 0 : MC.NON_SEM_CHANNELS, :, :]
+        global_non_sem = global_map[:, 0 : MC.NON_SEM_CHANNELS, :, :]
+        if self.channels_last:
+            global_non_sem = global_non_sem.contiguous(memory_format=torch.channels_last)
+        global_features = F.max_pool2d(global_non_sem, self.global_downscaling)
+
+        # Local obstacles, explored area, and current and past position, then
+        # global ones, then local semantic categories
+        map_features = torch.cat(
+            [
+                local_map[:, 0 : MC.NON_SEM_CHANNELS, :, :],
+                global_features,
+                local_map[:, MC.NON_SEM_CHANNELS :, :, :],
+            ],
+            dim=1,
         )
-        # Local semantic categories
-        map_features[:, 2 * MC.NON_SEM_CHANNELS :, :, :] = local_map[
-            :, MC.NON_SEM_CHANNELS :, :, :
-        ]
-
-        if debug_maps:
-            plt.subplot(131)
-            plt.imshow(local_map[0, 7])  # second object = cup
-            plt.subplot(132)
-            plt.imshow(local_map[0, 6])  # first object = chair
-            # This is the channel in MAP FEATURES mode
-            plt.subplot(133)
-            plt.imshow(map_features[0, 12])
-            plt.show()
 
         return map_features.detach()
+
+    def _plot_map_features(self, local_map: Tensor, map_features: Tensor):
+        """Plot a few local map and map feature channels of the first
+        environment (debug_maps only)."""
+        import matplotlib.pyplot as plt
+
+        plt.subplot(131)
+        plt.imshow(local_map[0, 7])  # second object = cup
+        plt.subplot(132)
+        plt.imshow(local_map[0, 6])  # first object = chair
+        # This is the channel in MAP FEATURES mode
+        plt.subplot(133)
+        plt.imshow(map_features[0, 12])
+        plt.show()
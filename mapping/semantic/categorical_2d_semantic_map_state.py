@@ -54,6 +54,7 @@ class Categorical2DSemanticMapState:
         map_size_cm: int,
         global_downscaling: int,
         probability_prior: float,
+        channels_last: bool = False,
     ):
         """
         Arguments:
@@ -64,6 +65,8 @@ class Categorical2DSemanticMapState:
             map_resolution: size of map bins (in centimeters)
             map_size_cm: global map size (in centimetres)
             global_downscaling: ratio of global over local map
+            channels_last: keep the local and global maps in channels_last
+             memory format, which the map module preserves
         """
         self.device = device
         self.num_environments = num_environments
@@ -90,20 +93,21 @@ class Categorical2DSemanticMapState:
         num_channels = self.num_sem_categories + MC.NON_SEM_CHANNELS # voxel height
         # num_channels = self.num_sem_categories + MC.NON_SEM_CHANNELS
 
+        memory_format = torch.channels_last if channels_last else torch.contiguous_format
         self.global_map = torch.zeros(
             self.num_environments,
             num_channels,
             self.global_map_size,
             self.global_map_size,
             device=self.device,
-        )
+        ).to(memory_format=memory_format)
         self.local_map = torch.zeros(
             self.num_environments,
             num_channels,
             self.local_map_size,
             self.local_map_size,
             device=self.device,
-        )
+        ).to(memory_format=memory_format)
 
         # Global and local (x, y, o) sensor pose
         # This is in the hab world frame (x: forward, y: left, z: up)  unit: meter
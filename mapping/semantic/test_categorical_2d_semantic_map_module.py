@@ -0,0 +1,131 @@
+import math
+
+import pytest
+import torch
+
+import mapping.map_utils as mu
+from mapping.semantic.categorical_2d_semantic_map_module import (
+    Categorical2DSemanticMapModule,
+)
+from mapping.semantic.constants import MapConstants as MC
+
+NUM_SEM_CATEGORIES = 5
+FRAME_HEIGHT, FRAME_WIDTH = 120, 160
+MAP_KWARGS = dict(
+    frame_height=FRAME_HEIGHT,
+    frame_width=FRAME_WIDTH,
+    camera_height=1.31,
+    hfov=69,
+    num_sem_categories=NUM_SEM_CATEGORIES,
+    map_size_cm=2400,
+    map_resolution=5,
+    vision_range=100,
+    explored_radius=150,
+    been_close_to_radius=100,
+    global_downscaling=2,
+    du_scale=1,
+    cat_pred_threshold=1.0,
+    exp_pred_threshold=1.0,
+    map_pred_threshold=1.0,
+    probability_prior=0.15,
+)
+
+
+def _init_maps():
+    params = mu.MapSizeParameters(
+        MAP_KWARGS["map_resolution"],
+        MAP_KWARGS["map_size_cm"],
+        MAP_KWARGS["global_downscaling"],
+    )
+    num_channels = MC.NON_SEM_CHANNELS + NUM_SEM_CATEGORIES
+    local_map = torch.zeros(
+        1, num_channels, params.local_map_size, params.local_map_size
+    )
+    global_map = torch.zeros(
+        1, num_channels, params.global_map_size, params.global_map_size
+    )
+    local_pose = torch.zeros(1, 3)
+    global_pose = torch.zeros(1, 3)
+    lmb = torch.zeros(1, 4, dtype=torch.int32)
+    origins = torch.zeros(1, 3)
+    mu.init_map_and_pose_for_env(
+        0, local_map, global_map, local_pose, global_pose, lmb, origins, params
+    )
+    prior_logit = math.log(MAP_KWARGS["probability_prior"])
+    prior_logit -= math.log(1 - MAP_KWARGS["probability_prior"])
+    for m in (local_map, global_map):
+        m[:, MC.PROBABILITY_MAP] = prior_logit
+        m[:, MC.VOXEL_START : MC.NON_SEM_CHANNELS] = -torch.inf
+    return local_map, global_map, local_pose, global_pose, lmb, origins
+
+
+def _run(module):
+    """One step in front of a wall 2.5m away, with a detected object covering
+    the lower half of the frame."""
+    obs = torch.zeros(1, 1, 4 + NUM_SEM_CATEGORIES, FRAME_HEIGHT, FRAME_WIDTH)
+    obs[:, :, 3] = 250.0
+    obs[:, :, 4 + 1, FRAME_HEIGHT // 2 :, 40:120] = 1.0
+    masks = torch.zeros(1, 1, FRAME_HEIGHT, FRAME_WIDTH, dtype=torch.bool)
+    masks[:, 0, FRAME_HEIGHT // 2 :, 40:120] = True
+    detection_results = [
+        {
+            "scores": torch.tensor([[0.3]]),
+            "classes": torch.tensor([[1]]),
+            "masks": masks,
+            "relevance": torch.tensor([0.0, 1.0, 0.0, 0.0, 0.0]),
+        }
+    ]
+    camera_pose = torch.eye(4).unsqueeze(0)
+    camera_pose[:, 2, 3] = MAP_KWARGS["camera_height"]
+    return module(
+        obs,
+        torch.zeros(1, 1, 3),
+        torch.zeros(1, 1, dtype=torch.bool),
+        torch.ones(1, 1, dtype=torch.bool),
+        camera_pose,
+        *_init_maps(),
+        detection_results=detection_results,
+    )
+
+
+def test_bfloat16_voxels_keep_prob_channel():
+    _, local_fp32, *_ = _run(Categorical2DSemanticMapModule(**MAP_KWARGS))
+    _, local_bf16, *_ = _run(
+        Categorical2DSemanticMapModule(**MAP_KWARGS, voxel_dtype=torch.bfloat16)
+    )
+
+    # The prob channel is splatted in float32 with either voxel_dtype, so the
+    # prob logits and the voxel logits agree to within 1e-4 (on the ±10 logit
+    # range). Which voxels are seen follows the bf16 occupancy, so the voxel
+    # logits are only compared where both maps have seen the voxel
+    prob_fp32 = local_fp32[:, MC.PROBABILITY_MAP]
+    prob_bf16 = local_bf16[:, MC.PROBABILITY_MAP]
+    assert torch.allclose(prob_fp32, prob_bf16, atol=1e-4)
+
+    voxels_fp32 = local_fp32[:, MC.VOXEL_START : MC.NON_SEM_CHANNELS]
+    voxels_bf16 = local_bf16[:, MC.VOXEL_START : MC.NON_SEM_CHANNELS]
+    seen = voxels_fp32.isfinite() & voxels_bf16.isfinite()
+    assert seen.any()
+    assert torch.allclose(voxels_fp32[seen], voxels_bf16[seen], atol=1e-4)
+
+
+def test_compiled_paths_off_by_default():
+    module = Categorical2DSemanticMapModule(**MAP_KWARGS)
+
+    assert not module.use_compile
+    assert module._update_voxel_map_fn == module._update_voxel_map
+    assert module._get_map_features_fn == module._get_map_features
+
+
+@pytest.mark.skipif(not hasattr(torch, "compile"), reason="needs torch >= 2.0")
+def test_use_compile_wraps_both_paths():
+    # torch.compile is lazy, nothing is compiled until the first call
+    module = Categorical2DSemanticMapModule(**MAP_KWARGS, use_compile=True)
+
+    assert module.use_compile
+    for fn, method in (
+        (module._update_voxel_map_fn, module._update_voxel_map),
+        (module._get_map_features_fn, module._get_map_features),
+    ):
+        assert fn != method
+        assert fn.__wrapped__ == method
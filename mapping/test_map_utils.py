@@ -0,0 +1,53 @@
+import torch
+
+import mapping.map_utils as mu
+
+
+def _map_and_pose(p, global_pose, num_channels=3):
+    num_envs = global_pose.size(0)
+    global_map = torch.rand(num_envs, num_channels, p.global_map_size, p.global_map_size)
+    local_map = torch.zeros(num_envs, num_channels, p.local_map_size, p.local_map_size)
+    local_pose = torch.zeros(num_envs, 3)
+    lmb = torch.zeros(num_envs, 4, dtype=torch.int32)
+    origins = torch.zeros(num_envs, 3)
+    return [local_map, global_map, local_pose, global_pose.clone(), lmb, origins]
+
+
+def _global_poses(p):
+    """Poses in the middle of the global map, within half a local map of each
+    edge and corner, and on the edges themselves (in metres)."""
+    size = p.global_map_size_cm / 100.0
+    margin = p.local_map_size_cm / 100.0 / 4
+    coords = [0.0, margin, size / 2, size - margin, size - 0.01]
+    return torch.tensor(
+        [[x, y, 0.3] for x in coords for y in coords], dtype=torch.float32
+    )
+
+
+def test_get_local_map_boundaries_batch():
+    for global_downscaling in (1, 2, 4):
+        p = mu.MapSizeParameters(5, 2400, global_downscaling)
+        global_loc = (_global_poses(p)[:, :2] * 100 / p.resolution).int()
+
+        expected = torch.stack(
+            [mu.get_local_map_boundaries(loc, p) for loc in global_loc]
+        )
+        assert torch.equal(mu.get_local_map_boundaries_batch(global_loc, p), expected)
+
+
+def test_recenter_local_map_and_pose_matches_per_env():
+    torch.manual_seed(0)
+    for global_downscaling in (1, 2, 4):
+        p = mu.MapSizeParameters(5, 2400, global_downscaling)
+        global_pose = _global_poses(p)
+        expected = _map_and_pose(p, global_pose)
+        batched = [x.clone() for x in expected]
+
+        # only some of the environments are re-centered
+        envs = torch.arange(0, global_pose.size(0), 2)
+        for e in envs.tolist():
+            mu.recenter_local_map_and_pose_for_env(e, *expected, p)
+        mu.recenter_local_map_and_pose(envs, *batched, p)
+
+        for x, y in zip(expected, batched):
+            assert torch.equal(x, y)
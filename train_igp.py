@@ -28,6 +28,9 @@ DEBUG = os.environ.get("DEBUG", 0)
 DEBUG = int(DEBUG)
 DEBUG = False
 
+# capped, each persistent worker keeps its own copy of the dataset in memory
+NUM_WORKERS = min(4, max(2, (os.cpu_count() or 2) // 4))
+
 def vis(voxel,pred,gt):
     voxel = voxel[0].cpu().detach()
     pred = pred[0].cpu().detach()
@@ -52,8 +55,9 @@ def train_epoch(net,dataloader,optimizer,epoch,logger):
     losses = deque(maxlen=10)
     log_interval = 10
 
+    device = next(net.parameters()).device
     for step, batch in enumerate(dataloader):
-        voxel, info_map = batch
+        voxel, info_map = (x.to(device, non_blocking=True) for x in batch)
         # vis(voxel,info_map,info_map)
         optimizer.zero_grad()
         pred = net(voxel)
@@ -66,12 +70,14 @@ def train_epoch(net,dataloader,optimizer,epoch,logger):
             print(f"Epoch {epoch}, Step {step}, Loss {np.mean(losses)}")
             logger.add_scalar("train/loss",np.mean(losses),step+epoch*len(dataloader))
 
+@torch.no_grad()
 def eval_epoch(net,dataloader):
     net.eval()
     log_interval = 10
     all_loss = []
+    device = next(net.parameters()).device
     for step, batch in enumerate(dataloader):
-        voxel, info_map = batch
+        voxel, info_map = (x.to(device, non_blocking=True) for x in batch)
         pred = net(voxel)
         if DEBUG:
             if (info_map[0,1] > 1).sum() > 0:
@@ -137,16 +143,17 @@ def eval(args, config):
     dataloader_eval = get_dataloader(data_dir="data/info_gain",
                                 split="test",
                                 batch_size=config.train.batch_size,
-                                num_workers=0,
+                                num_workers=NUM_WORKERS,
                                 data_config=config.dataloader,
-                                device = device,
-                                shuffle=True)
+                                device = 'cpu',
+                                shuffle=True,
+                                pin_memory=True,
+                                persistent_workers=True)
                                      
     net = IGPNet(config.dataloader,config.net)
     net.load_state_dict(torch.load(f"{model_dir}/best.pth"))
     net.to(device)
-    with torch.no_grad():
-        mae, std = eval_epoch(net,dataloader_eval)
+    mae, std = eval_epoch(net,dataloader_eval)
     print(f"Eval MAE {mae}, std {std}")
 
 
@@ -158,17 +165,21 @@ def train(args,config):
     dataloader = get_dataloader(data_dir="data/info_gain",
                                 split="train",
                                 batch_size=config.train.batch_size,
-                                num_workers=0,
+                                num_workers=NUM_WORKERS,
                                 data_config=config.dataloader,
-                                device = device,
-                                shuffle=True)
+                                device = 'cpu',
+                                shuffle=True,
+                                pin_memory=True,
+                                persistent_workers=True)
     dataloader_eval = get_dataloader(data_dir="data/info_gain",
                                 split="test",
                                 batch_size=config.train.batch_size,
-                                num_workers=0,
+                                num_workers=NUM_WORKERS,
                                 data_config=config.dataloader,
-                                device = device,
-                                shuffle=True)
+                                device = 'cpu',
+                                shuffle=True,
+                                pin_memory=True,
+                                persistent_workers=True)
                                      
     net = IGPNet(config.dataloader,config.net)
     net.to(device)
@@ -184,8 +195,7 @@ def train(args,config):
     
     for epoch in range(train_epoch_num):
         train_epoch(net,dataloader,optimizer, epoch, logger)
-        with torch.no_grad():
-            loss = eval_epoch(net,dataloader_eval)
+        loss = eval_epoch(net,dataloader_eval)
         logger.add_scalar("eval/loss",loss,epoch)
         if loss < best_loss:
             best_loss = loss
@@ -186,4 +186,37 @@ def get_affine_grid_no_scaling(translation, theta, out_size, device):
     trans_rot = torch.bmm(rot_matrix, trans_matrix)
 
     grid = F.affine_grid(trans_rot[:,2,:],out_size)
-    return grid
\ No newline at end of file
+    return grid
+
+def get_rot_trans_grid_batch(pose, out_size):
+    """
+    Get a single sampling grid that rotates then translates a map, equivalent to
+    sampling with both grids of home_robot.utils.rotation.get_grid one after the
+    other but with one grid_sample call.
+
+    ### Parameters:
+        - pose: torch.tensor of size: [N, 3] for x, y (normalized map coords) and theta (degrees)
+        - out_size: list of [N, C, H, W]
+    ### Return:
+        - torch.tensor of size [N, H, W, 2], to be sampled with align_corners=True
+    """
+    pose = pose.float()
+    x = pose[:, 0]
+    y = pose[:, 1]
+    t = torch.deg2rad(pose[:, 2])
+    cos_t = t.cos()
+    sin_t = t.sin()
+
+    # get_grid builds its grids with align_corners=False while they are sampled
+    # with align_corners=True, which rescales the intermediate grid by (n-1)/n
+    h, w = out_size[-2], out_size[-1]
+    sx = (w - 1) / w
+    sy = (h - 1) / h
+
+    # rot_matrix @ diag(sx, sy) @ trans_matrix
+    theta1 = torch.stack([cos_t * sx, -sin_t * sy, cos_t * sx * x - sin_t * sy * y], 1)
+    theta2 = torch.stack([sin_t * sx, cos_t * sy, sin_t * sx * x + cos_t * sy * y], 1)
+    theta = torch.stack([theta1, theta2], 1)
+
+    grid = F.affine_grid(theta, torch.Size(out_size), align_corners=False)
+    return grid
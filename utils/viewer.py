@@ -8,37 +8,43 @@ class OpenCVViewer:
         self.name = name
         cv2.namedWindow(name, cv2.WINDOW_NORMAL) # use cv2.WINDOW_NORMAL to allow window resizing for large images
         self.exit_on_escape = exit_on_escape
+        # output of the RGB to BGR conversion, reused across frames of the same shape
+        self._bgr_buf = None
+
+        # keycode -> action, upper case keys map to the same actions
+        key_actions = {
+            "a": DiscreteNavigationAction.TURN_LEFT,  # Left
+            "d": DiscreteNavigationAction.TURN_RIGHT,  # Right
+            "s": DiscreteNavigationAction.STOP,  # Back
+            "w": DiscreteNavigationAction.MOVE_FORWARD,  # Forward
+        }
+        self._key_actions = {}
+        for c, action in key_actions.items():
+            self._key_actions[ord(c)] = action
+            self._key_actions[ord(c.upper())] = action
 
     def parse_key(self, key):
- 
-        c = chr(key).lower()
-        if c == "a":
-            # Left
-            # base_action = [0, 1]
-            action = DiscreteNavigationAction.TURN_LEFT
-        elif c == "d":
-            # Right
-            action = DiscreteNavigationAction.TURN_RIGHT
-        elif c == "s":
-            # Back
-            action = DiscreteNavigationAction.STOP
-        elif c == "w":
-            # Forward
-            action = DiscreteNavigationAction.MOVE_FORWARD
-        else:
-            action = None
+        return self._key_actions.get(key & 0xFF)
 
-        return action
-    
     def imshow(self, image: np.ndarray, rgb=True, non_blocking=False, delay=0):
-        if image.ndim == 2:
-            image = np.tile(image[..., np.newaxis], (1, 1, 3))
-        elif image.ndim == 3 and image.shape[-1] == 1:
-            image = np.tile(image, (1, 1, 3))
-        assert image.ndim == 3, image.shape
+        # grayscale images are shown by cv2.imshow directly, no need to expand them
+        # to 3 channels
+        if image.ndim == 3 and image.shape[-1] == 1:
+            image = image[..., 0]
+        assert image.ndim in (2, 3), image.shape
 
-        if rgb:
-            image = image[..., ::-1]
+        if rgb and image.ndim == 3:
+            if image.shape[-1] == 3 and image.dtype in (np.uint8, np.uint16, np.float32):
+                if (
+                    self._bgr_buf is None
+                    or self._bgr_buf.shape != image.shape
+                    or self._bgr_buf.dtype != image.dtype
+                ):
+                    self._bgr_buf = np.empty(image.shape, dtype=image.dtype)
+                image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=self._bgr_buf)
+            else:
+                # channel counts and dtypes cvtColor does not handle
+                image = image[..., ::-1]
         cv2.imshow(self.name, image)
 
         if non_blocking: